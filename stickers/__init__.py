@@ -1,15 +1,18 @@
 import uuid
 import time
 import re
+import base64
 from ipaddress import ip_address
 from enum import Enum
 from datetime import datetime, timezone
 
 from sqlalchemy import Table, Column, PrimaryKeyConstraint, LargeBinary as sqla_binary, Float
-from sqlalchemy import Integer, String, MetaData, distinct
+from sqlalchemy import Index, inspect
+from sqlalchemy import Integer, String, MetaData
 from sqlalchemy.dialects.mysql import VARBINARY as mysql_binary
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.sql import func, and_, or_
+from sqlalchemy.sql import func, and_, or_, select, bindparam
 
 from statement_helper import sort_statement, paginate_statement, id_filter
 from statement_helper import time_cutoff_filter, string_like_filter
@@ -18,6 +21,62 @@ from statement_helper import bitwise_filter
 from idcollection import IDCollection
 from parse_id import parse_id, get_id_bytes, generate_or_parse_id
 
+def try_get_id_bytes(id):
+	try:
+		return get_id_bytes(id)
+	except (ValueError, TypeError):
+		return None
+
+def encode_cursor(time, id_bytes):
+	return base64.urlsafe_b64encode(
+		(str(int(time)) + ':' + bytes(id_bytes).hex()).encode('ascii')
+	).decode('ascii')
+
+def decode_cursor(cursor):
+	try:
+		time, id = base64.urlsafe_b64decode(cursor).decode('ascii').split(':')
+		return int(time), bytes.fromhex(id)
+	except (TypeError, ValueError):
+		raise ValueError('Invalid cursor') from None
+
+def id_tiebreak_statement(statement, id_column, order):
+	# matches the (time, id) ordering cursor pagination continues from
+	if 'asc' == order:
+		return statement.order_by(id_column.asc())
+	return statement.order_by(id_column.desc())
+
+def cursor_paginate_statement(
+		statement,
+		time_column,
+		id_column,
+		cursor,
+		order,
+		perpage,
+	):
+	time, id_bytes = decode_cursor(cursor)
+	if 'asc' == order:
+		statement = statement.where(
+			or_(
+				time_column > time,
+				and_(time_column == time, id_column > id_bytes),
+			)
+		).order_by(time_column.asc(), id_column.asc())
+	else:
+		statement = statement.where(
+			or_(
+				time_column < time,
+				and_(time_column == time, id_column < id_bytes),
+			)
+		).order_by(time_column.desc(), id_column.desc())
+	return paginate_statement(statement, 0, perpage)
+
+class SearchResult(IDCollection):
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		# None when the search didn't check for further results
+		self.has_more = None
+		self.next_cursor = None
+
 class Sticker:
 	def __init__(
 			self,
@@ -34,22 +93,24 @@ class Sticker:
 		if None == creation_time:
 			creation_time = time.time()
 		self.creation_time = int(creation_time)
-		self.creation_datetime = datetime.fromtimestamp(
-			self.creation_time,
-			timezone.utc,
-		)
 
 		self.name = str(name)
 		self.display = str(display)
 		self.category = str(category)
 		self.category_order = int(category_order)
 
-		if isinstance(group_bits, int):
-			group_bits = group_bits.to_bytes(2, 'big')
-		else:
-			group_bits = bytes(group_bits)
+		if not isinstance(group_bits, int):
+			group_bits = int.from_bytes(bytes(group_bits), 'big')
 		self.group_bits = group_bits
 
+	@property
+	def creation_datetime(self):
+		return datetime.fromtimestamp(self.creation_time, timezone.utc)
+
+	@property
+	def group_bits_bytes(self):
+		return self.group_bits.to_bytes(2, 'big')
+
 class CollectedSticker:
 	def __init__(
 			self,
@@ -63,16 +124,16 @@ class CollectedSticker:
 		if None == receive_time:
 			receive_time = time.time()
 		self.receive_time = int(receive_time)
-		self.receive_datetime = datetime.fromtimestamp(
-			self.receive_time,
-			timezone.utc,
-		)
 
 		self.user_id, self.user_id_bytes = parse_id(user_id)
 		self.sticker_id, self.sticker_id_bytes = parse_id(sticker_id)
 
 		self.sticker = None
 
+	@property
+	def receive_datetime(self):
+		return datetime.fromtimestamp(self.receive_time, timezone.utc)
+
 class StickerPlacement:
 	def __init__(
 			self,
@@ -91,10 +152,6 @@ class StickerPlacement:
 		if None == placement_time:
 			placement_time = time.time()
 		self.placement_time = int(placement_time)
-		self.placement_datetime = datetime.fromtimestamp(
-			self.placement_time,
-			timezone.utc,
-		)
 
 		self.subject_id, self.subject_id_bytes = generate_or_parse_id(subject_id)
 		self.user_id, self.user_id_bytes = parse_id(user_id)
@@ -107,6 +164,10 @@ class StickerPlacement:
 
 		self.sticker = None
 
+	@property
+	def placement_datetime(self):
+		return datetime.fromtimestamp(self.placement_time, timezone.utc)
+
 class Stickers:
 	def __init__(self, engine, db_prefix='', install=False, connection=None):
 		self.engine = engine
@@ -118,6 +179,20 @@ class Stickers:
 		self.display_length = 32
 		self.category_length = 16
 
+		# stream large pages instead of fetching them whole
+		self.stream_results_threshold = 1000
+		self.stream_results_buffer = 1000
+
+		self.unique_categories_cache = None
+		self.unique_categories_cache_time = 0
+		self.unique_categories_cache_ttl = 60
+
+		self.unique_grants_index_name = (
+			self.db_prefix + 'ix_collected_stickers_user_sticker'
+		)
+		# None until checked against the database
+		self.unique_grants_indexed = None
+
 		metadata = MetaData()
 
 		default_bytes = 0b0 * 16
@@ -139,6 +214,12 @@ class Stickers:
 			Column('category_order', Integer, default=0),
 			Column('group_bits', Integer, default=0),
 			PrimaryKeyConstraint('id'),
+			Index(
+				self.db_prefix + 'ix_stickers_creation_time_id',
+				'creation_time',
+				'id',
+			),
+			Index(self.db_prefix + 'ix_stickers_category', 'category'),
 		)
 
 		# collected stickers tables
@@ -150,6 +231,17 @@ class Stickers:
 			Column('user_id', Binary(16), default=default_bytes),
 			Column('sticker_id', Binary(16), default=default_bytes),
 			PrimaryKeyConstraint('id'),
+			Index(
+				self.db_prefix + 'ix_collected_stickers_receive_time_id',
+				'receive_time',
+				'id',
+			),
+			Index(
+				self.unique_grants_index_name,
+				'user_id',
+				'sticker_id',
+				unique=True,
+			),
 		)
 
 		# placed stickers tables
@@ -166,6 +258,60 @@ class Stickers:
 			Column('rotation', Float, default=0),
 			Column('scale', Float, default=0),
 			PrimaryKeyConstraint('id'),
+			Index(
+				self.db_prefix + 'ix_sticker_placements_placement_time_id',
+				'placement_time',
+				'id',
+			),
+			Index(
+				self.db_prefix + 'ix_sticker_placements_subject_user_time',
+				'subject_id',
+				'user_id',
+				'placement_time',
+			),
+			Index(
+				self.db_prefix + 'ix_sticker_placements_user_sticker_subject',
+				'user_id',
+				'sticker_id',
+				'subject_id',
+			),
+		)
+
+		# reused single row statements
+		self.insert_sticker_statement = self.stickers.insert()
+		self.delete_sticker_statement = self.stickers.delete().where(
+			self.stickers.c.id == bindparam('id_bytes')
+		)
+		self.insert_collected_sticker_statement = (
+			self.collected_stickers.insert()
+		)
+		self.delete_collected_sticker_statement = (
+			self.collected_stickers.delete().where(
+				self.collected_stickers.c.id == bindparam('id_bytes')
+			)
+		)
+		self.delete_sticker_collected_stickers_statement = (
+			self.collected_stickers.delete().where(
+				self.collected_stickers.c.sticker_id == bindparam('id_bytes')
+			)
+		)
+		self.insert_sticker_placement_statement = (
+			self.sticker_placements.insert()
+		)
+		self.delete_sticker_placement_statement = (
+			self.sticker_placements.delete().where(
+				self.sticker_placements.c.id == bindparam('id_bytes')
+			)
+		)
+		self.delete_sticker_sticker_placements_statement = (
+			self.sticker_placements.delete().where(
+				self.sticker_placements.c.sticker_id == bindparam('id_bytes')
+			)
+		)
+		self.delete_user_sticker_placements_statement = (
+			self.sticker_placements.delete().where(
+				self.sticker_placements.c.user_id == bindparam('id_bytes')
+			)
 		)
 
 		if connection:
@@ -180,6 +326,43 @@ class Stickers:
 					self.sticker_placements,
 				]:
 				table.create(bind=self.engine, checkfirst=True)
+			self.create_missing_indexes()
+
+	def create_missing_indexes(self):
+		# table.create(checkfirst=True) skips indexes of tables that exist
+		inspector = inspect(self.engine)
+		for table in [
+				self.stickers,
+				self.collected_stickers,
+				self.sticker_placements,
+			]:
+			existing_indexes = [
+				index['name'] for index in inspector.get_indexes(table.name)
+			]
+			for index in table.indexes:
+				if index.name in existing_indexes:
+					continue
+				if self.unique_grants_index_name != index.name:
+					index.create(bind=self.engine)
+					continue
+				try:
+					index.create(bind=self.engine)
+				except (IntegrityError, OperationalError):
+					# existing duplicate grants, e.g. from ids anonymized into
+					# a shared id before the index existed, block the unique
+					# index so grants keep their preflight duplicate check
+					pass
+		self.unique_grants_indexed = None
+
+	def has_unique_grants_index(self):
+		if None == self.unique_grants_indexed:
+			self.unique_grants_indexed = self.unique_grants_index_name in [
+				index['name']
+				for index in inspect(self.engine).get_indexes(
+					self.collected_stickers.name
+				)
+			]
+		return self.unique_grants_indexed
 
 	def uninstall(self):
 		for table in [
@@ -194,7 +377,7 @@ class Stickers:
 		stickers = self.search_stickers(filter={'ids': id})
 		return stickers.get(id)
 
-	def prepare_stickers_search_statement(self, filter):
+	def prepare_stickers_search_conditions(self, filter):
 		conditions = []
 		conditions += id_filter(filter, 'ids', self.stickers.c.id)
 		conditions += time_cutoff_filter(
@@ -223,17 +406,25 @@ class Stickers:
 			self.stickers.c.group_bits,
 		)
 
+		return conditions
+
+	def prepare_stickers_search_statement(self, filter):
+		conditions = self.prepare_stickers_search_conditions(filter)
 		statement = self.stickers.select()
 		if conditions:
 			statement = statement.where(and_(*conditions))
 		return statement
 
+	def prepare_stickers_count_statement(self, filter):
+		conditions = self.prepare_stickers_search_conditions(filter)
+		statement = select([func.count(self.stickers.c.id)])
+		if conditions:
+			statement = statement.where(and_(*conditions))
+		return statement
+
 	def count_stickers(self, filter={}):
-		statement = self.prepare_stickers_search_statement(filter)
-		statement = statement.with_only_columns(
-			[func.count(self.stickers.c.id)]
-		)
-		return self.connection.execute(statement).fetchone()[0]
+		statement = self.prepare_stickers_count_statement(filter)
+		return self.connection.execute(statement).scalar()
 
 	def search_stickers(
 			self,
@@ -241,76 +432,181 @@ class Stickers:
 			sort='',
 			order='',
 			page=0,
-			perpage=None
+			perpage=None,
+			cursor=None,
+			fetch_has_more=True,
+			stream_results=False,
 		):
 		statement = self.prepare_stickers_search_statement(filter)
 
-		statement = sort_statement(
-			statement,
-			self.stickers,
-			sort,
-			order,
-			'creation_time',
-			True,
-			[
+		if cursor:
+			if sort not in ('', 'creation_time'):
+				raise ValueError('Cursor pagination requires sorting by creation_time')
+			statement = cursor_paginate_statement(
+				statement,
+				self.stickers.c.creation_time,
+				self.stickers.c.id,
+				cursor,
+				order,
+				perpage,
+			)
+		else:
+			statement = sort_statement(
+				statement,
+				self.stickers,
+				sort,
+				order,
 				'creation_time',
-				'id',
-			],
-		)
-		statement = paginate_statement(statement, page, perpage)
+				True,
+				[
+					'creation_time',
+					'id',
+				],
+			)
+			if sort in ('', 'creation_time'):
+				statement = id_tiebreak_statement(
+					statement,
+					self.stickers.c.id,
+					order,
+				)
+			statement = paginate_statement(statement, page, perpage)
+		if perpage and fetch_has_more:
+			# one extra row to tell if there's another page without a count
+			statement = statement.limit(perpage + 1)
+		if stream_results or (
+				perpage
+				and self.stream_results_threshold < perpage
+			):
+			statement = statement.execution_options(
+				stream_results=True,
+				max_row_buffer=self.stream_results_buffer,
+			)
 
-		result = self.connection.execute(statement).fetchall()
-		if 0 == len(result):
-			return IDCollection()
+		result = self.connection.execute(statement)
 
-		stickers = IDCollection()
-		for row in result:
-			sticker = Sticker(
-				id=row[self.stickers.c.id],
-				creation_time=row[self.stickers.c.creation_time],
-				name=row[self.stickers.c.name],
-				display=row[self.stickers.c.display],
-				category=row[self.stickers.c.category],
-				category_order=row[self.stickers.c.category_order],
-				group_bits=row[self.stickers.c.group_bits],
-			)
+		has_more = None
+		if perpage and fetch_has_more:
+			has_more = False
+		rows = 0
 
-			stickers.add(sticker)
+		id_column = self.stickers.c.id
+		creation_time_column = self.stickers.c.creation_time
+		name_column = self.stickers.c.name
+		display_column = self.stickers.c.display
+		category_column = self.stickers.c.category
+		category_order_column = self.stickers.c.category_order
+		group_bits_column = self.stickers.c.group_bits
+
+		stickers = SearchResult()
+		try:
+			for row in result:
+				if perpage and perpage == rows:
+					has_more = True
+					break
+				rows += 1
+				sticker = Sticker(
+					id=row[id_column],
+					creation_time=row[creation_time_column],
+					name=row[name_column],
+					display=row[display_column],
+					category=row[category_column],
+					category_order=row[category_order_column],
+					group_bits=row[group_bits_column],
+				)
+
+				stickers.add(sticker)
+		finally:
+			result.close()
+		stickers.has_more = has_more
+		if (
+				perpage
+				and perpage == rows
+				and False != has_more
+				and sort in ('', 'creation_time')
+			):
+			stickers.next_cursor = encode_cursor(
+				sticker.creation_time,
+				sticker.id_bytes,
+			)
 		return stickers
 
+	def joined_sticker(self, row, sticker_id_column, stickers):
+		sticker_id = row[sticker_id_column]
+		if None == sticker_id:
+			return None
+		if sticker_id not in stickers:
+			columns = self.stickers.c
+			stickers[sticker_id] = Sticker(
+				id=sticker_id,
+				creation_time=row[columns.creation_time],
+				name=row[columns.name],
+				display=row[columns.display],
+				category=row[columns.category],
+				category_order=row[columns.category_order],
+				group_bits=row[columns.group_bits],
+			)
+		return stickers[sticker_id]
+
 	# manipulate stickers
 	def create_sticker(self, **kwargs):
 		sticker = Sticker(**kwargs)
-		# preflight check for existing id
-		if self.count_stickers(filter={'ids': sticker.id_bytes}):
-			raise ValueError('Sticker ID collision')
-		self.connection.execute(
-			self.stickers.insert(),
-			id=sticker.id_bytes,
-			creation_time=int(sticker.creation_time),
-			name=str(sticker.name),
-			display=str(sticker.display),
-			category=str(sticker.category),
-			category_order=int(sticker.category_order),
-			group_bits=int.from_bytes(sticker.group_bits, 'big'),
-		)
+		# id collisions are left to the primary key
+		try:
+			self.connection.execute(
+				self.insert_sticker_statement,
+				id=sticker.id_bytes,
+				creation_time=sticker.creation_time,
+				name=sticker.name,
+				display=sticker.display,
+				category=sticker.category,
+				category_order=sticker.category_order,
+				group_bits=sticker.group_bits,
+			)
+		except IntegrityError:
+			raise ValueError('Sticker ID collision') from None
+		self.clear_unique_categories_cache()
 		return sticker
 
+	def create_stickers(self, stickers):
+		stickers = [Sticker(**kwargs) for kwargs in stickers]
+		created_stickers = IDCollection()
+		if not stickers:
+			return created_stickers
+		rows = []
+		for sticker in stickers:
+			rows.append({
+				'id': sticker.id_bytes,
+				'creation_time': sticker.creation_time,
+				'name': sticker.name,
+				'display': sticker.display,
+				'category': sticker.category,
+				'category_order': sticker.category_order,
+				'group_bits': sticker.group_bits,
+			})
+			created_stickers.add(sticker)
+		try:
+			with self.connection.begin():
+				self.connection.execute(self.insert_sticker_statement, rows)
+		except IntegrityError:
+			raise ValueError('Sticker ID collision') from None
+		self.clear_unique_categories_cache()
+		return created_stickers
+
 	def update_sticker(self, id, **kwargs):
 		sticker = Sticker(id=id, **kwargs)
 		updates = {}
 		if 'creation_time' in kwargs:
-			updates['creation_time'] = int(sticker.creation_time)
+			updates['creation_time'] = sticker.creation_time
 		if 'name' in kwargs:
-			updates['name'] = str(sticker.name)
+			updates['name'] = sticker.name
 		if 'display' in kwargs:
-			updates['display'] = str(sticker.display)
+			updates['display'] = sticker.display
 		if 'category' in kwargs:
-			updates['category'] = str(sticker.category)
+			updates['category'] = sticker.category
 		if 'category_order' in kwargs:
-			updates['category_order'] = int(sticker.category_order)
+			updates['category_order'] = sticker.category_order
 		if 'group_bits' in kwargs:
-			updates['group_bits'] = int.from_bytes(sticker.group_bits, 'big')
+			updates['group_bits'] = sticker.group_bits
 		if 0 == len(updates):
 			return
 		self.connection.execute(
@@ -318,29 +614,29 @@ class Stickers:
 				self.stickers.c.id == sticker.id_bytes
 			)
 		)
+		if 'category' in updates:
+			self.clear_unique_categories_cache()
 
 	def delete_sticker(self, id):
 		id = get_id_bytes(id)
-		self.connection.execute(
-			self.collected_stickers.delete().where(
-				self.collected_stickers.c.id == id
+		with self.connection.begin():
+			self.connection.execute(
+				self.delete_sticker_collected_stickers_statement,
+				id_bytes=id,
 			)
-		)
-		self.connection.execute(
-			self.sticker_placements.delete().where(
-				self.sticker_placements.c.id == id
+			self.connection.execute(
+				self.delete_sticker_sticker_placements_statement,
+				id_bytes=id,
 			)
-		)
-		self.connection.execute(
-			self.stickers.delete().where(self.stickers.c.id == id)
-		)
+			self.connection.execute(self.delete_sticker_statement, id_bytes=id)
+		self.clear_unique_categories_cache()
 
 	# retrieve collected stickers
 	def get_collected_sticker(self, id):
 		collected_stickers = self.search_collected_stickers(filter={'ids': id})
 		return collected_stickers.get(id)
 
-	def prepare_collected_stickers_search_statement(self, filter):
+	def prepare_collected_stickers_search_conditions(self, filter):
 		conditions = []
 		conditions += id_filter(filter, 'ids', self.collected_stickers.c.id)
 		conditions += time_cutoff_filter(
@@ -359,17 +655,28 @@ class Stickers:
 			self.collected_stickers.c.sticker_id,
 		)
 
-		statement = self.collected_stickers.select()
+		return conditions
+
+	def prepare_collected_stickers_search_statement(self, filter):
+		conditions = self.prepare_collected_stickers_search_conditions(filter)
+		statement = self.collected_stickers.outerjoin(
+			self.stickers,
+			self.collected_stickers.c.sticker_id == self.stickers.c.id,
+		).select().apply_labels()
+		if conditions:
+			statement = statement.where(and_(*conditions))
+		return statement
+
+	def prepare_collected_stickers_count_statement(self, filter):
+		conditions = self.prepare_collected_stickers_search_conditions(filter)
+		statement = select([func.count(self.collected_stickers.c.id)])
 		if conditions:
 			statement = statement.where(and_(*conditions))
 		return statement
 
 	def count_collected_stickers(self, filter={}):
-		statement = self.prepare_collected_stickers_search_statement(filter)
-		statement = statement.with_only_columns(
-			[func.count(self.collected_stickers.c.id)]
-		)
-		return self.connection.execute(statement).fetchone()[0]
+		statement = self.prepare_collected_stickers_count_statement(filter)
+		return self.connection.execute(statement).scalar()
 
 	def search_collected_stickers(
 			self,
@@ -377,81 +684,204 @@ class Stickers:
 			sort='',
 			order='',
 			page=0,
-			perpage=None
+			perpage=None,
+			cursor=None,
+			fetch_has_more=True,
+			stream_results=False,
 		):
 		statement = self.prepare_collected_stickers_search_statement(filter)
 
-		statement = sort_statement(
-			statement,
-			self.collected_stickers,
-			sort,
-			order,
-			'receive_time',
-			True,
-			[
+		if cursor:
+			if sort not in ('', 'receive_time'):
+				raise ValueError('Cursor pagination requires sorting by receive_time')
+			statement = cursor_paginate_statement(
+				statement,
+				self.collected_stickers.c.receive_time,
+				self.collected_stickers.c.id,
+				cursor,
+				order,
+				perpage,
+			)
+		else:
+			statement = sort_statement(
+				statement,
+				self.collected_stickers,
+				sort,
+				order,
 				'receive_time',
-				'id',
-			],
-		)
-		statement = paginate_statement(statement, page, perpage)
+				True,
+				[
+					'receive_time',
+					'id',
+				],
+			)
+			if sort in ('', 'receive_time'):
+				statement = id_tiebreak_statement(
+					statement,
+					self.collected_stickers.c.id,
+					order,
+				)
+			statement = paginate_statement(statement, page, perpage)
+		if perpage and fetch_has_more:
+			# one extra row to tell if there's another page without a count
+			statement = statement.limit(perpage + 1)
+		if stream_results or (
+				perpage
+				and self.stream_results_threshold < perpage
+			):
+			statement = statement.execution_options(
+				stream_results=True,
+				max_row_buffer=self.stream_results_buffer,
+			)
 
-		result = self.connection.execute(statement).fetchall()
-		if 0 == len(result):
-			return IDCollection()
+		result = self.connection.execute(statement)
 
-		sticker_ids = []
-		for row in result:
-			sticker_ids.append(row[self.collected_stickers.c.sticker_id])
+		has_more = None
+		if perpage and fetch_has_more:
+			has_more = False
+		rows = 0
 
-		stickers = self.search_stickers(filter={'sticker_ids': sticker_ids})
+		id_column = self.collected_stickers.c.id
+		receive_time_column = self.collected_stickers.c.receive_time
+		user_id_column = self.collected_stickers.c.user_id
+		sticker_id_column = self.collected_stickers.c.sticker_id
+		joined_sticker_id_column = self.stickers.c.id
 
-		collected_stickers = IDCollection()
-		for row in result:
-			collected_sticker = CollectedSticker(
-				id=row[self.collected_stickers.c.id],
-				receive_time=row[self.collected_stickers.c.receive_time],
-				user_id=row[self.collected_stickers.c.user_id],
-				sticker_id=row[self.collected_stickers.c.sticker_id],
-			)
-			if collected_sticker.sticker_id_bytes in stickers:
-				collected_sticker.sticker = stickers.get(
-					collected_sticker.sticker_id_bytes
+		stickers = {}
+		collected_stickers = SearchResult()
+		try:
+			for row in result:
+				if perpage and perpage == rows:
+					has_more = True
+					break
+				rows += 1
+				collected_sticker = CollectedSticker(
+					id=row[id_column],
+					receive_time=row[receive_time_column],
+					user_id=row[user_id_column],
+					sticker_id=row[sticker_id_column],
+				)
+				collected_sticker.sticker = self.joined_sticker(
+					row,
+					joined_sticker_id_column,
+					stickers,
 				)
 
-			collected_stickers.add(collected_sticker)
+				collected_stickers.add(collected_sticker)
+		finally:
+			result.close()
+		collected_stickers.has_more = has_more
+		if (
+				perpage
+				and perpage == rows
+				and False != has_more
+				and sort in ('', 'receive_time')
+			):
+			collected_stickers.next_cursor = encode_cursor(
+				collected_sticker.receive_time,
+				collected_sticker.id_bytes,
+			)
 		return collected_stickers
 
 	# manipulate collected stickers
 	def grant_sticker(self, sticker_id, user_id, receive_time=None):
 		sticker_id = get_id_bytes(sticker_id)
 		user_id = get_id_bytes(user_id)
-		collected_stickers = self.search_collected_stickers(
-			filter={'user_ids': user_id, 'sticker_ids': sticker_id},
-		)
-		if 0 < len(collected_stickers):
-			raise ValueError('Specified user already has the specified sticker')
 		collected_sticker = CollectedSticker(
 			user_id=user_id,
 			sticker_id=sticker_id,
 			receive_time=receive_time,
 		)
-		if self.count_collected_stickers(filter={'ids': collected_sticker.id_bytes}):
-			raise ValueError('Collected sticker ID collision')
-		self.connection.execute(
-			self.collected_stickers.insert(),
-			id=collected_sticker.id_bytes,
-			receive_time=int(collected_sticker.receive_time),
-			user_id=collected_sticker.user_id_bytes,
-			sticker_id=collected_sticker.sticker_id_bytes,
-		)
+		# preflight check for installs missing the unique index
+		if not self.has_unique_grants_index():
+			if self.count_collected_stickers(
+					filter={'user_ids': user_id, 'sticker_ids': sticker_id},
+				):
+				raise ValueError('Specified user already has the specified sticker')
+		try:
+			self.connection.execute(
+				self.insert_collected_sticker_statement,
+				id=collected_sticker.id_bytes,
+				receive_time=collected_sticker.receive_time,
+				user_id=collected_sticker.user_id_bytes,
+				sticker_id=collected_sticker.sticker_id_bytes,
+			)
+		except IntegrityError:
+			# the unique user and sticker index, or a negligible id collision
+			raise ValueError(
+				'Specified user already has the specified sticker'
+			) from None
 		return collected_sticker
 
+	def grant_stickers(self, grants):
+		collected_stickers = [
+			CollectedSticker(
+				user_id=get_id_bytes(grant['user_id']),
+				sticker_id=get_id_bytes(grant['sticker_id']),
+				receive_time=grant.get('receive_time'),
+			) for grant in grants
+		]
+		granted_stickers = IDCollection()
+		if not collected_stickers:
+			return granted_stickers
+		pairs = set()
+		for collected_sticker in collected_stickers:
+			pair = (
+				collected_sticker.user_id_bytes,
+				collected_sticker.sticker_id_bytes,
+			)
+			if pair in pairs:
+				raise ValueError('Specified user already has the specified sticker')
+			pairs.add(pair)
+		# preflight check for installs missing the unique index
+		if not self.has_unique_grants_index():
+			result = self.connection.execute(
+				select([
+					self.collected_stickers.c.user_id,
+					self.collected_stickers.c.sticker_id,
+				]).where(
+					and_(
+						self.collected_stickers.c.user_id.in_(
+							list({user_id for user_id, sticker_id in pairs})
+						),
+						self.collected_stickers.c.sticker_id.in_(
+							list({sticker_id for user_id, sticker_id in pairs})
+						),
+					)
+				)
+			).fetchall()
+			for row in result:
+				if (bytes(row[0]), bytes(row[1])) in pairs:
+					raise ValueError(
+						'Specified user already has the specified sticker'
+					)
+		rows = []
+		for collected_sticker in collected_stickers:
+			rows.append({
+				'id': collected_sticker.id_bytes,
+				'receive_time': collected_sticker.receive_time,
+				'user_id': collected_sticker.user_id_bytes,
+				'sticker_id': collected_sticker.sticker_id_bytes,
+			})
+			granted_stickers.add(collected_sticker)
+		try:
+			with self.connection.begin():
+				self.connection.execute(
+					self.insert_collected_sticker_statement,
+					rows,
+				)
+		except IntegrityError:
+			# the unique user and sticker index, or a negligible id collision
+			raise ValueError(
+				'Specified user already has the specified sticker'
+			) from None
+		return granted_stickers
+
 	def revoke_sticker(self, id):
 		id = get_id_bytes(id)
 		self.connection.execute(
-			self.collected_stickers.delete().where(
-				self.collected_stickers.c.id == id,
-			)
+			self.delete_collected_sticker_statement,
+			id_bytes=id,
 		)
 
 	def get_collected_stickers(self, user_id):
@@ -462,7 +892,7 @@ class Stickers:
 		sticker_placements = self.search_sticker_placements(filter={'ids': id})
 		return sticker_placements.get(id)
 
-	def prepare_sticker_placements_search_statement(self, filter):
+	def prepare_sticker_placements_search_conditions(self, filter):
 		conditions = []
 		conditions += id_filter(filter, 'ids', self.sticker_placements.c.id)
 		conditions += time_cutoff_filter(
@@ -486,17 +916,28 @@ class Stickers:
 			self.sticker_placements.c.sticker_id,
 		)
 
-		statement = self.sticker_placements.select()
+		return conditions
+
+	def prepare_sticker_placements_search_statement(self, filter):
+		conditions = self.prepare_sticker_placements_search_conditions(filter)
+		statement = self.sticker_placements.outerjoin(
+			self.stickers,
+			self.sticker_placements.c.sticker_id == self.stickers.c.id,
+		).select().apply_labels()
+		if conditions:
+			statement = statement.where(and_(*conditions))
+		return statement
+
+	def prepare_sticker_placements_count_statement(self, filter):
+		conditions = self.prepare_sticker_placements_search_conditions(filter)
+		statement = select([func.count(self.sticker_placements.c.id)])
 		if conditions:
 			statement = statement.where(and_(*conditions))
 		return statement
 
 	def count_sticker_placements(self, filter={}):
-		statement = self.prepare_sticker_placements_search_statement(filter)
-		statement = statement.with_only_columns(
-			[func.count(self.sticker_placements.c.id)]
-		)
-		return self.connection.execute(statement).fetchone()[0]
+		statement = self.prepare_sticker_placements_count_statement(filter)
+		return self.connection.execute(statement).scalar()
 
 	def search_sticker_placements(
 			self,
@@ -504,154 +945,247 @@ class Stickers:
 			sort='',
 			order='',
 			page=0,
-			perpage=None
+			perpage=None,
+			cursor=None,
+			fetch_has_more=True,
+			stream_results=False,
 		):
 		statement = self.prepare_sticker_placements_search_statement(filter)
 
-		statement = sort_statement(
-			statement,
-			self.sticker_placements,
-			sort,
-			order,
-			'placement_time',
-			True,
-			[
+		if cursor:
+			if sort not in ('', 'placement_time'):
+				raise ValueError('Cursor pagination requires sorting by placement_time')
+			statement = cursor_paginate_statement(
+				statement,
+				self.sticker_placements.c.placement_time,
+				self.sticker_placements.c.id,
+				cursor,
+				order,
+				perpage,
+			)
+		else:
+			statement = sort_statement(
+				statement,
+				self.sticker_placements,
+				sort,
+				order,
 				'placement_time',
-				'id',
-			],
-		)
-		statement = paginate_statement(statement, page, perpage)
-
-		result = self.connection.execute(statement).fetchall()
-		if 0 == len(result):
-			return IDCollection()
-
-		sticker_ids = []
-		for row in result:
-			sticker_ids.append(row[self.sticker_placements.c.sticker_id])
-
-		stickers = self.search_stickers(filter={'sticker_ids': sticker_ids})
-
-		sticker_placements = IDCollection()
-		for row in result:
-			sticker_placement = StickerPlacement(
-				id=row[self.sticker_placements.c.id],
-				placement_time=row[self.sticker_placements.c.placement_time],
-				subject_id=row[self.sticker_placements.c.subject_id],
-				user_id=row[self.sticker_placements.c.user_id],
-				sticker_id=row[self.sticker_placements.c.sticker_id],
-				position_x=row[self.sticker_placements.c.position_x],
-				position_y=row[self.sticker_placements.c.position_y],
-				rotation=row[self.sticker_placements.c.rotation],
-				scale=row[self.sticker_placements.c.scale],
+				True,
+				[
+					'placement_time',
+					'id',
+				],
 			)
-			if sticker_placement.sticker_id_bytes in stickers:
-				sticker_placement.sticker = stickers.get(
-					sticker_placement.sticker_id_bytes
+			if sort in ('', 'placement_time'):
+				statement = id_tiebreak_statement(
+					statement,
+					self.sticker_placements.c.id,
+					order,
+				)
+			statement = paginate_statement(statement, page, perpage)
+		if perpage and fetch_has_more:
+			# one extra row to tell if there's another page without a count
+			statement = statement.limit(perpage + 1)
+		if stream_results or (
+				perpage
+				and self.stream_results_threshold < perpage
+			):
+			statement = statement.execution_options(
+				stream_results=True,
+				max_row_buffer=self.stream_results_buffer,
+			)
+
+		result = self.connection.execute(statement)
+
+		has_more = None
+		if perpage and fetch_has_more:
+			has_more = False
+		rows = 0
+
+		id_column = self.sticker_placements.c.id
+		placement_time_column = self.sticker_placements.c.placement_time
+		subject_id_column = self.sticker_placements.c.subject_id
+		user_id_column = self.sticker_placements.c.user_id
+		sticker_id_column = self.sticker_placements.c.sticker_id
+		position_x_column = self.sticker_placements.c.position_x
+		position_y_column = self.sticker_placements.c.position_y
+		rotation_column = self.sticker_placements.c.rotation
+		scale_column = self.sticker_placements.c.scale
+		joined_sticker_id_column = self.stickers.c.id
+
+		stickers = {}
+		sticker_placements = SearchResult()
+		try:
+			for row in result:
+				if perpage and perpage == rows:
+					has_more = True
+					break
+				rows += 1
+				sticker_placement = StickerPlacement(
+					id=row[id_column],
+					placement_time=row[placement_time_column],
+					subject_id=row[subject_id_column],
+					user_id=row[user_id_column],
+					sticker_id=row[sticker_id_column],
+					position_x=row[position_x_column],
+					position_y=row[position_y_column],
+					rotation=row[rotation_column],
+					scale=row[scale_column],
+				)
+				sticker_placement.sticker = self.joined_sticker(
+					row,
+					joined_sticker_id_column,
+					stickers,
 				)
 
-			sticker_placements.add(sticker_placement)
+				sticker_placements.add(sticker_placement)
+		finally:
+			result.close()
+		sticker_placements.has_more = has_more
+		if (
+				perpage
+				and perpage == rows
+				and False != has_more
+				and sort in ('', 'placement_time')
+			):
+			sticker_placements.next_cursor = encode_cursor(
+				sticker_placement.placement_time,
+				sticker_placement.id_bytes,
+			)
 		return sticker_placements
 
 	# manipulate sticker placements
 	def place_sticker(self, **kwargs):
 		sticker_placement = StickerPlacement(**kwargs)
 		self.connection.execute(
-			self.sticker_placements.insert(),
+			self.insert_sticker_placement_statement,
 			id=sticker_placement.id_bytes,
-			placement_time=int(sticker_placement.placement_time),
+			placement_time=sticker_placement.placement_time,
 			subject_id=sticker_placement.subject_id_bytes,
 			user_id=sticker_placement.user_id_bytes,
 			sticker_id=sticker_placement.sticker_id_bytes,
-			position_x=float(sticker_placement.position_x),
-			position_y=float(sticker_placement.position_y),
-			rotation=float(sticker_placement.rotation),
-			scale=float(sticker_placement.scale),
+			position_x=sticker_placement.position_x,
+			position_y=sticker_placement.position_y,
+			rotation=sticker_placement.rotation,
+			scale=sticker_placement.scale,
 		)
 		return sticker_placement
 
+	def place_stickers(self, placements):
+		sticker_placements = [
+			StickerPlacement(**kwargs) for kwargs in placements
+		]
+		placed_stickers = IDCollection()
+		if not sticker_placements:
+			return placed_stickers
+		rows = []
+		for sticker_placement in sticker_placements:
+			rows.append({
+				'id': sticker_placement.id_bytes,
+				'placement_time': sticker_placement.placement_time,
+				'subject_id': sticker_placement.subject_id_bytes,
+				'user_id': sticker_placement.user_id_bytes,
+				'sticker_id': sticker_placement.sticker_id_bytes,
+				'position_x': sticker_placement.position_x,
+				'position_y': sticker_placement.position_y,
+				'rotation': sticker_placement.rotation,
+				'scale': sticker_placement.scale,
+			})
+			placed_stickers.add(sticker_placement)
+		try:
+			with self.connection.begin():
+				self.connection.execute(
+					self.insert_sticker_placement_statement,
+					rows,
+				)
+		except IntegrityError:
+			raise ValueError('Sticker placement ID collision') from None
+		return placed_stickers
+
 	def unplace_sticker(self, id):
 		id = get_id_bytes(id)
 		self.connection.execute(
-			self.sticker_placements.delete().where(
-				self.sticker_placements.c.id == id
-			)
+			self.delete_sticker_placement_statement,
+			id_bytes=id,
 		)
 
-	#TODO tests
 	def prune_user_sticker_placements(self, subject_id, user_id, maximum_stickers):
-		try:
-			subject_id = get_id_bytes(subject_id)
-		#TODO narrow catch
-		except:
-			return
-		try:
-			user_id = get_id_bytes(user_id)
-		#TODO narrow catch
-		except:
+		subject_id = try_get_id_bytes(subject_id)
+		user_id = try_get_id_bytes(user_id)
+		if None == subject_id or None == user_id:
 			return
-		placements = self.search_sticker_placements(
-			filter={
-				'subject_ids': subject_id,
-				'user_ids': user_id,
-			},
-			sort='placement_time',
-			order='desc',
+		placement_conditions = and_(
+			self.sticker_placements.c.subject_id == subject_id,
+			self.sticker_placements.c.user_id == user_id,
 		)
-		conditions = []
-		i = 0
-		for placement in placements.values():
-			i += 1
-			if i < maximum_stickers:
-				continue
-			conditions.append(self.sticker_placements.c.id == placement.id_bytes)
-		if not conditions:
-			return
+		# wrapped in a derived table since mysql won't limit/offset inside
+		# an in() subquery or select from the table being deleted from
+		excess_placements = select([self.sticker_placements.c.id]).where(
+			placement_conditions
+		).order_by(
+			self.sticker_placements.c.placement_time.desc(),
+			self.sticker_placements.c.id.desc(),
+		).offset(max(0, maximum_stickers - 1)).alias('excess_placements')
 		statement = self.sticker_placements.delete().where(
 			and_(
-				self.sticker_placements.c.subject_id == subject_id,
-				self.sticker_placements.c.user_id == user_id,
-				or_(*conditions),
+				placement_conditions,
+				self.sticker_placements.c.id.in_(
+					select([excess_placements.c.id])
+				),
 			)
 		)
 		self.connection.execute(statement)
 
 	#TODO tests
 	def unplace_by_user(self, user_id):
-		try:
-			user_id = get_id_bytes(user_id)
-		#TODO narrow catch
-		except:
+		user_id = try_get_id_bytes(user_id)
+		if None == user_id:
 			return
 		self.connection.execute(
-			self.sticker_placements.delete().where(
-				self.sticker_placements.c.user_id == user_id
-			)
+			self.delete_user_sticker_placements_statement,
+			id_bytes=user_id,
 		)
 
 	# unique categories
 	def get_unique_categories(self):
-		statement = self.stickers.select().with_only_columns(
-			[self.stickers.c.category]
-		).group_by(self.stickers.c.category)
+		if (
+				None != self.unique_categories_cache
+				and time.time() < (
+					self.unique_categories_cache_time
+					+ self.unique_categories_cache_ttl
+				)
+			):
+			return list(self.unique_categories_cache)
+		statement = select([self.stickers.c.category]).distinct()
 		result = self.engine.execute(statement).fetchall()
 		unique_categories = []
 		for row in result:
 			unique_categories.append(row[self.stickers.c.category])
-		return unique_categories
+		self.unique_categories_cache = unique_categories
+		self.unique_categories_cache_time = time.time()
+		return list(unique_categories)
+
+	def clear_unique_categories_cache(self):
+		self.unique_categories_cache = None
 
 	#TODO tests
 	def get_user_unique_sticker_placement_counts(self, user_id):
 		user_id = get_id_bytes(user_id)
-		statement = self.sticker_placements.select().where(
-			self.sticker_placements.c.user_id == user_id
-		).with_only_columns(
+		placed_subjects = select(
 			[
 				self.sticker_placements.c.sticker_id,
-				func.count(distinct(self.sticker_placements.c.subject_id)),
+				self.sticker_placements.c.subject_id,
+			]
+		).where(
+			self.sticker_placements.c.user_id == user_id
+		).distinct().alias('placed_subjects')
+		statement = select(
+			[
+				placed_subjects.c.sticker_id,
+				func.count(),
 			]
 		).group_by(
-			self.sticker_placements.c.sticker_id
+			placed_subjects.c.sticker_id
 		)
 		result = self.connection.execute(statement).fetchall()
 		unique_sticker_placement_counts = {}
@@ -665,14 +1199,15 @@ class Stickers:
 	def get_subject_sticker_placement_counts(self, subject_ids):
 		if list != type(subject_ids):
 			subject_ids = [subject_ids]
-		conditions = []
+		if not subject_ids:
+			return {}
+		# map result bytes back to the already parsed ids
+		parsed_subject_ids = {}
 		for subject_id in subject_ids:
 			subject_id, subject_id_bytes = parse_id(subject_id)
-			conditions.append(
-				self.sticker_placements.c.subject_id == subject_id_bytes
-			)
+			parsed_subject_ids[subject_id_bytes] = subject_id
 		statement = self.sticker_placements.select().where(
-			or_(*conditions)
+			self.sticker_placements.c.subject_id.in_(list(parsed_subject_ids))
 		).with_only_columns(
 			[
 				self.sticker_placements.c.subject_id,
@@ -684,8 +1219,8 @@ class Stickers:
 		result = self.connection.execute(statement).fetchall()
 		subject_sticker_placement_counts = {}
 		for row in result:
-			subject_id, count = row
-			subject_id, subject_id_bytes = parse_id(subject_id)
+			subject_id_bytes, count = row
+			subject_id = parsed_subject_ids[subject_id_bytes]
 			subject_sticker_placement_counts[subject_id] = count
 		return subject_sticker_placement_counts
 
@@ -693,18 +1228,43 @@ class Stickers:
 	def anonymize_id(self, id, new_id=None):
 		id = get_id_bytes(id)
 
+		# only a caller supplied new id can already hold stickers
+		merge = bool(new_id) and new_id != id
 		if not new_id:
 			new_id = uuid.uuid4().bytes
 
-		self.connection.execute(
-			self.collected_stickers.update().values(user_id=new_id).where(
-				self.collected_stickers.c.user_id == id,
+		with self.connection.begin():
+			if merge:
+				# merging into an id that already holds a sticker deletes the
+				# old id's grant of that sticker instead of violating the unique
+				# user and sticker index, so that sticker's grant count drops
+				# by one per merged duplicate
+				# wrapped in a derived table since mysql won't select from the
+				# table being deleted from
+				held_stickers = select(
+					[self.collected_stickers.c.sticker_id]
+				).where(
+					self.collected_stickers.c.user_id == new_id
+				).alias('held_stickers')
+				self.connection.execute(
+					self.collected_stickers.delete().where(
+						and_(
+							self.collected_stickers.c.user_id == id,
+							self.collected_stickers.c.sticker_id.in_(
+								select([held_stickers.c.sticker_id])
+							),
+						)
+					)
+				)
+			self.connection.execute(
+				self.collected_stickers.update().values(user_id=new_id).where(
+					self.collected_stickers.c.user_id == id,
+				)
 			)
-		)
-		self.connection.execute(
-			self.sticker_placements.update().values(user_id=new_id).where(
-				self.sticker_placements.c.user_id == id,
+			self.connection.execute(
+				self.sticker_placements.update().values(user_id=new_id).where(
+					self.sticker_placements.c.user_id == id,
+				)
 			)
-		)
 
 		return new_id
@@ -0,0 +1,349 @@
+import unittest
+import uuid
+
+try:
+	from sqlalchemy import create_engine
+	from stickers import Stickers
+except ImportError:
+	Stickers = None
+
+@unittest.skipIf(None == Stickers, 'stickers dependencies not installed')
+class TestStickers(unittest.TestCase):
+	def setUp(self):
+		self.engine = create_engine('sqlite://')
+		self.stickers = Stickers(self.engine, install=True)
+
+	def tearDown(self):
+		self.stickers.uninstall()
+
+	def page_through(self, **kwargs):
+		ids = []
+		cursor = None
+		while True:
+			stickers = self.stickers.search_stickers(cursor=cursor, **kwargs)
+			for sticker in stickers.values():
+				ids.append(sticker.id_bytes)
+			cursor = stickers.next_cursor
+			if not cursor:
+				return ids
+
+	def test_cursor_pagination_tied_timestamps(self):
+		created_stickers = self.stickers.create_stickers(
+			[{'creation_time': 100, 'category': 'x'} for i in range(10)]
+		)
+		expected_ids = [sticker.id_bytes for sticker in created_stickers.values()]
+		for order in ['', 'asc', 'desc']:
+			ids = self.page_through(
+				filter={'category': 'x'},
+				order=order,
+				perpage=3,
+			)
+			self.assertEqual(len(ids), len(set(ids)))
+			self.assertEqual(sorted(ids), sorted(expected_ids))
+
+	def test_delete_sticker_removes_grants_and_placements(self):
+		sticker = self.stickers.create_sticker()
+		other_sticker = self.stickers.create_sticker()
+		user_id = uuid.uuid4().bytes
+		subject_id = uuid.uuid4().bytes
+		for current_sticker in [sticker, other_sticker]:
+			self.stickers.grant_sticker(current_sticker.id_bytes, user_id)
+			self.stickers.place_sticker(
+				subject_id=subject_id,
+				user_id=user_id,
+				sticker_id=current_sticker.id_bytes,
+			)
+		self.stickers.delete_sticker(sticker.id_bytes)
+		self.assertEqual(
+			0,
+			self.stickers.count_stickers(filter={'ids': sticker.id_bytes}),
+		)
+		for sticker_id, expected_count in [
+				(sticker.id_bytes, 0),
+				(other_sticker.id_bytes, 1),
+			]:
+			self.assertEqual(
+				expected_count,
+				self.stickers.count_collected_stickers(
+					filter={'sticker_ids': sticker_id},
+				),
+			)
+			self.assertEqual(
+				expected_count,
+				self.stickers.count_sticker_placements(
+					filter={'sticker_ids': sticker_id},
+				),
+			)
+
+	def place_for_pruning(self, subject_id, user_id):
+		sticker = self.stickers.create_sticker()
+		placements = []
+		for placement_time in [100, 100, 100, 200, 200, 300]:
+			placements.append(
+				self.stickers.place_sticker(
+					placement_time=placement_time,
+					subject_id=subject_id,
+					user_id=user_id,
+					sticker_id=sticker.id_bytes,
+				)
+			)
+		return placements
+
+	def placement_ids(self, subject_id, user_id):
+		placements = self.stickers.search_sticker_placements(
+			filter={'subject_ids': subject_id, 'user_ids': user_id},
+		)
+		return {placement.id_bytes for placement in placements.values()}
+
+	def test_prune_user_sticker_placements(self):
+		for maximum_stickers in [0, 1, 3]:
+			subject_id = uuid.uuid4().bytes
+			user_id = uuid.uuid4().bytes
+			placements = self.place_for_pruning(subject_id, user_id)
+			other_pairs = [
+				(subject_id, uuid.uuid4().bytes),
+				(uuid.uuid4().bytes, user_id),
+			]
+			other_placements = {}
+			for other_pair in other_pairs:
+				other_placements[other_pair] = {
+					placement.id_bytes
+					for placement in self.place_for_pruning(*other_pair)
+				}
+
+			self.stickers.prune_user_sticker_placements(
+				subject_id,
+				user_id,
+				maximum_stickers,
+			)
+
+			# keeps the newest maximum_stickers - 1, ties broken by id
+			newest = sorted(
+				placements,
+				key=lambda placement: (placement.placement_time, placement.id_bytes),
+				reverse=True,
+			)
+			self.assertEqual(
+				{placement.id_bytes for placement in newest[:max(0, maximum_stickers - 1)]},
+				self.placement_ids(subject_id, user_id),
+			)
+			for other_pair in other_pairs:
+				self.assertEqual(
+					other_placements[other_pair],
+					self.placement_ids(*other_pair),
+				)
+
+	def test_invalid_ids_unplace_nothing(self):
+		subject_id = uuid.uuid4().bytes
+		user_id = uuid.uuid4().bytes
+		placement_ids = {
+			placement.id_bytes
+			for placement in self.place_for_pruning(subject_id, user_id)
+		}
+		self.stickers.prune_user_sticker_placements('invalid', user_id, 0)
+		self.stickers.prune_user_sticker_placements(subject_id, 'invalid', 0)
+		self.stickers.unplace_by_user('invalid')
+		self.assertEqual(placement_ids, self.placement_ids(subject_id, user_id))
+
+	def assert_has_more(self, search, filter):
+		# four matching rows
+		for page, perpage, expected_count, expected_has_more in [
+				(0, 2, 2, True),
+				(1, 2, 2, False),
+				(0, 3, 3, True),
+				(0, 4, 4, False),
+				(0, 5, 4, False),
+			]:
+			results = search(filter=filter, page=page, perpage=perpage)
+			self.assertEqual(expected_count, len(results))
+			self.assertIs(expected_has_more, results.has_more)
+			self.assertEqual(expected_has_more, None != results.next_cursor)
+		results = search(filter=filter, perpage=2, fetch_has_more=False)
+		self.assertEqual(2, len(results))
+		self.assertIsNone(results.has_more)
+		self.assertIsNotNone(results.next_cursor)
+		results = search(filter=filter)
+		self.assertEqual(4, len(results))
+		self.assertIsNone(results.has_more)
+		self.assertIsNone(results.next_cursor)
+
+	def test_search_has_more(self):
+		user_id = uuid.uuid4().bytes
+		subject_id = uuid.uuid4().bytes
+		for i in range(4):
+			sticker = self.stickers.create_sticker(category='has_more')
+			self.stickers.grant_sticker(sticker.id_bytes, user_id)
+			self.stickers.place_sticker(
+				subject_id=subject_id,
+				user_id=user_id,
+				sticker_id=sticker.id_bytes,
+			)
+		self.assert_has_more(
+			self.stickers.search_stickers,
+			{'category': 'has_more'},
+		)
+		self.assert_has_more(
+			self.stickers.search_collected_stickers,
+			{'user_ids': user_id},
+		)
+		self.assert_has_more(
+			self.stickers.search_sticker_placements,
+			{'subject_ids': subject_id},
+		)
+
+	def test_batch_empty(self):
+		self.assertEqual(0, len(self.stickers.create_stickers([])))
+		self.assertEqual(0, len(self.stickers.grant_stickers([])))
+		self.assertEqual(0, len(self.stickers.place_stickers([])))
+
+	def test_batch(self):
+		created_stickers = self.stickers.create_stickers(
+			[{'name': 'batch' + str(i), 'category': 'batch'} for i in range(3)]
+		)
+		self.assertEqual(3, len(created_stickers))
+		self.assertEqual(
+			3,
+			self.stickers.count_stickers(filter={'category': 'batch'}),
+		)
+		user_id = uuid.uuid4().bytes
+		subject_id = uuid.uuid4().bytes
+		granted_stickers = self.stickers.grant_stickers([
+			{'sticker_id': sticker.id_bytes, 'user_id': user_id}
+			for sticker in created_stickers.values()
+		])
+		self.assertEqual(3, len(granted_stickers))
+		self.assertEqual(
+			3,
+			self.stickers.count_collected_stickers(filter={'user_ids': user_id}),
+		)
+		placed_stickers = self.stickers.place_stickers([
+			{
+				'subject_id': subject_id,
+				'user_id': user_id,
+				'sticker_id': sticker.id_bytes,
+			}
+			for sticker in created_stickers.values()
+		])
+		self.assertEqual(3, len(placed_stickers))
+		self.assertEqual(
+			3,
+			self.stickers.count_sticker_placements(
+				filter={'subject_ids': subject_id},
+			),
+		)
+
+	def test_batch_duplicate_grant_pair(self):
+		sticker = self.stickers.create_sticker()
+		user_id = uuid.uuid4().bytes
+		with self.assertRaises(ValueError):
+			self.stickers.grant_stickers([
+				{'sticker_id': sticker.id_bytes, 'user_id': user_id},
+				{'sticker_id': sticker.id_bytes, 'user_id': user_id},
+			])
+		self.assertEqual(
+			0,
+			self.stickers.count_collected_stickers(filter={'user_ids': user_id}),
+		)
+
+	def test_batch_collision_rolls_back(self):
+		sticker = self.stickers.create_sticker()
+		with self.assertRaises(ValueError):
+			self.stickers.create_stickers([
+				{'category': 'rollback'},
+				{'id': sticker.id_bytes, 'category': 'rollback'},
+			])
+		self.assertEqual(
+			0,
+			self.stickers.count_stickers(filter={'category': 'rollback'}),
+		)
+
+		user_id = uuid.uuid4().bytes
+		other_sticker = self.stickers.create_sticker()
+		self.stickers.grant_sticker(sticker.id_bytes, user_id)
+		with self.assertRaises(ValueError):
+			self.stickers.grant_stickers([
+				{'sticker_id': other_sticker.id_bytes, 'user_id': user_id},
+				{'sticker_id': sticker.id_bytes, 'user_id': user_id},
+			])
+		self.assertEqual(
+			1,
+			self.stickers.count_collected_stickers(filter={'user_ids': user_id}),
+		)
+
+		subject_id = uuid.uuid4().bytes
+		placement = self.stickers.place_sticker(
+			subject_id=uuid.uuid4().bytes,
+			user_id=user_id,
+			sticker_id=sticker.id_bytes,
+		)
+		with self.assertRaises(ValueError):
+			self.stickers.place_stickers([
+				{
+					'subject_id': subject_id,
+					'user_id': user_id,
+					'sticker_id': sticker.id_bytes,
+				},
+				{
+					'id': placement.id_bytes,
+					'subject_id': subject_id,
+					'user_id': user_id,
+					'sticker_id': sticker.id_bytes,
+				},
+			])
+		self.assertEqual(
+			0,
+			self.stickers.count_sticker_placements(
+				filter={'subject_ids': subject_id},
+			),
+		)
+
+	def test_grant_sticker_twice(self):
+		sticker = self.stickers.create_sticker()
+		user_id = uuid.uuid4().bytes
+		self.stickers.grant_sticker(sticker.id_bytes, user_id)
+		with self.assertRaises(ValueError):
+			self.stickers.grant_sticker(sticker.id_bytes, user_id)
+		with self.assertRaises(ValueError):
+			self.stickers.grant_stickers(
+				[{'sticker_id': sticker.id_bytes, 'user_id': user_id}]
+			)
+
+	def test_anonymize_ids_into_shared_id(self):
+		sticker = self.stickers.create_sticker()
+		user_ids = [uuid.uuid4().bytes, uuid.uuid4().bytes]
+		for user_id in user_ids:
+			self.stickers.grant_sticker(sticker.id_bytes, user_id)
+		shared_id = uuid.uuid4().bytes
+		for user_id in user_ids:
+			self.stickers.anonymize_id(user_id, shared_id)
+		self.assertEqual(
+			1,
+			self.stickers.count_collected_stickers(filter={'user_ids': shared_id}),
+		)
+
+	def test_install_with_existing_duplicate_grants(self):
+		# databases from before the unique index can hold duplicate grants
+		for index in self.stickers.collected_stickers.indexes:
+			if self.stickers.unique_grants_index_name == index.name:
+				index.drop(bind=self.engine)
+		sticker = self.stickers.create_sticker()
+		user_id = uuid.uuid4().bytes
+		for i in range(2):
+			self.stickers.connection.execute(
+				self.stickers.collected_stickers.insert(),
+				id=uuid.uuid4().bytes,
+				receive_time=0,
+				user_id=user_id,
+				sticker_id=sticker.id_bytes,
+			)
+		stickers = Stickers(self.engine, install=True)
+		self.assertFalse(stickers.has_unique_grants_index())
+		with self.assertRaises(ValueError):
+			stickers.grant_sticker(sticker.id_bytes, user_id)
+		other_user_id = uuid.uuid4().bytes
+		stickers.grant_sticker(sticker.id_bytes, other_user_id)
+		with self.assertRaises(ValueError):
+			stickers.grant_sticker(sticker.id_bytes, other_user_id)
+
+if __name__ == '__main__':
+	unittest.main()